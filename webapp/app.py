@@ -1,4 +1,4 @@
-import json
+import orjson
 import os
 import pika
 import time 
@@ -22,6 +22,10 @@ QUEUE_NAME_RESULTS = "cola_resultados_finales" # <-- Para que el Worker Recomend
 # {request_id: recomendaciones_json}
 RESULTS_CACHE = {} 
 
+# Cola de respuesta exclusiva de esta instancia (RPC con reply_to/correlation_id).
+# La crea el hilo consumidor; None mientras no exista (se usa la cola de resultados compartida)
+REPLY_QUEUE = None
+
 # Variables globales para la conexión persistente de publicación
 RABBITMQ_CONNECTION_PUBLISH = None
 RABBITMQ_CHANNEL_PUBLISH = None
@@ -60,6 +64,7 @@ def get_rabbitmq_connection_and_channel(queue_name):
 # --- CONSUMIDOR ASÍNCRONO DE RESULTADOS ---
 def start_result_consumer():
     """Se ejecuta en un hilo separado para escuchar los resultados finales."""
+    global REPLY_QUEUE
     connection = None
     try:
         # Usamos la cola de resultados para la conexión del consumidor
@@ -71,7 +76,7 @@ def start_result_consumer():
         def result_callback(ch, method, properties, body):
             """Función que se llama al recibir el resultado final."""
             try:
-                data = json.loads(body)
+                data = orjson.loads(body)
                 request_id = data.get("request_id")
                 recommendations = data.get("recommendations") # Obtener la lista de recomendaciones
                 
@@ -88,13 +93,22 @@ def start_result_consumer():
                 # En caso de error, NACK y re-encolar
                 ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True) 
 
+        # Cola de respuesta propia (nombre asignado por el broker, se borra al cerrar la conexión):
+        # el recomendador responde aquí directamente. Si la cola ya no existe cuando llega la respuesta
+        # (reinicio o reconexión), el recomendador la publica en la cola durable compartida,
+        # que esta instancia también consume
+        reply_queue = channel.queue_declare(queue='', exclusive=True).method.queue
+
         channel.basic_consume(queue=QUEUE_NAME_RESULTS, on_message_callback=result_callback, auto_ack=False)
-        print(f"✅ Hilo Consumidor de Resultados listo. Esperando mensajes en: {QUEUE_NAME_RESULTS}")
+        channel.basic_consume(queue=reply_queue, on_message_callback=result_callback, auto_ack=False)
+        REPLY_QUEUE = reply_queue
+        print(f"✅ Hilo Consumidor de Resultados listo. Esperando mensajes en: {QUEUE_NAME_RESULTS} y {reply_queue}")
         channel.start_consuming()
 
     except Exception as e:
         print(f"🚨 Error crítico en el Hilo Consumidor de Resultados: {e}")
     finally:
+        REPLY_QUEUE = None # La cola exclusiva desaparece con la conexión
         if connection and connection.is_open:
             print("🔌 Hilo Consumidor: Conexión de RabbitMQ cerrada.")
             connection.close()
@@ -464,7 +478,7 @@ def recommend():
 
     try:
         # El payload ahora contiene la consulta original y el request_id
-        payload = json.dumps({"query": user_query, "request_id": request_id})
+        payload = orjson.dumps({"query": user_query, "request_id": request_id})
         
         RABBITMQ_CHANNEL_PUBLISH.basic_publish(
             exchange='',
@@ -472,6 +486,8 @@ def recommend():
             body=payload,
             properties=pika.BasicProperties(
                 delivery_mode=2, # Hace el mensaje persistente
+                reply_to=REPLY_QUEUE, # El resultado vuelve directo a esta instancia (o a la cola compartida)
+                correlation_id=request_id
             )
         )
         print(f"Web App: Mensaje enviado a RabbitMQ (Emotion Queue): '{user_query}' con ID: {request_id}")
@@ -0,0 +1,146 @@
+"""
+Modelo S-BERT compartido por los workers.
+
+El catálogo (worker_inicial) y las consultas (worker_recomendador) deben codificarse con
+exactamente el mismo modelo y la misma configuración; por eso la carga vive en un solo lugar.
+"""
+import os
+import contextlib
+import numpy as np
+
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+# GPU con FP16 si está disponible (SBERT_DEVICE permite forzar 'cpu' o 'cuda')
+try:
+    import torch
+    CUDA_AVAILABLE = torch.cuda.is_available()
+except ImportError:
+    torch = None
+    CUDA_AVAILABLE = False
+
+# Hilos de PyTorch en CPU: TORCH_NUM_THREADS fija los intra-op (por defecto, los de OMP/MKL);
+# los inter-op no aportan con un solo modelo secuencial y solo compiten por los núcleos
+if torch is not None:
+    if os.getenv('TORCH_NUM_THREADS'):
+        torch.set_num_threads(int(os.getenv('TORCH_NUM_THREADS')))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass # Ya fijado (solo puede hacerse una vez por proceso)
+SBERT_DEVICE = os.getenv('SBERT_DEVICE') or ('cuda' if CUDA_AVAILABLE else 'cpu')
+
+# Backend opcional: SBERT_BACKEND=onnx carga el export ONNX cuantizado a INT8 (VNNI)
+# que publica el repositorio del modelo (requiere 'optimum[onnxruntime]').
+# El catálogo y las consultas deben usar el mismo backend: los vectores INT8 difieren levemente.
+# Un backend pedido explícitamente que no puede cargarse detiene el worker (sin fallback).
+SBERT_BACKEND = os.getenv('SBERT_BACKEND', 'torch').lower()
+SBERT_ONNX_FILE = os.getenv('SBERT_ONNX_FILE', 'onnx/model_qint8_avx512_vnni.onnx')
+# SBERT_BACKEND=model2vec usa una destilación estática del modelo (búsqueda en tabla + promedio,
+# sin transformer). Se genera una vez, fuera de los workers:
+#   from model2vec.distill import distill
+#   distill(MODEL_NAME, pca_dims=None).save_pretrained("minilm-m2v")
+# pca_dims=None conserva las 384 dimensiones de la columna 'embedding'. Al cambiar de backend,
+# worker_inicial detecta el cambio de ENCODER_ID y regenera los embeddings del catálogo.
+SBERT_M2V_MODEL = os.getenv('SBERT_M2V_MODEL')
+
+
+class DummyModel:
+    """Reemplazo sin IA cuando el modelo no puede cargarse: vectores nulos de 384 dimensiones."""
+    def encode(self, texts, *args, **kwargs):
+        if isinstance(texts, str):
+            return np.zeros(384, dtype=np.float32)
+        return np.zeros((len(texts), 384), dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return 384
+
+
+class StaticEmbeddingModel:
+    """Adaptador de model2vec con la misma interfaz de encode que SentenceTransformer."""
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False, **kwargs):
+        embeddings = np.asarray(self.model.encode(texts, batch_size=batch_size, show_progress_bar=False), dtype=np.float32)
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, 1e-12)
+        return embeddings
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.dim
+
+
+def load_requested_backend():
+    """
+    Carga el backend pedido explícitamente con SBERT_BACKEND (onnx o model2vec).
+    Sin fallback: si el catálogo se codificó con este backend, consultar con otro modelo
+    pondría consultas y catálogo en espacios vectoriales distintos.
+    """
+    if SBERT_BACKEND == 'model2vec':
+        if not SBERT_M2V_MODEL:
+            raise RuntimeError("SBERT_BACKEND=model2vec requiere SBERT_M2V_MODEL")
+        from model2vec import StaticModel
+        model = StaticEmbeddingModel(StaticModel.from_pretrained(SBERT_M2V_MODEL))
+        print(f"✅ Modelo estático model2vec cargado ({SBERT_M2V_MODEL}).")
+        return model
+    if SBERT_BACKEND == 'onnx':
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(
+            MODEL_NAME,
+            device=SBERT_DEVICE,
+            backend='onnx',
+            model_kwargs={'file_name': SBERT_ONNX_FILE}
+        )
+        print(f"✅ Modelo S-BERT cargado con ONNX Runtime ({SBERT_ONNX_FILE}).")
+        return model
+    raise RuntimeError(f"SBERT_BACKEND desconocido: '{SBERT_BACKEND}' (torch, onnx o model2vec)")
+
+
+if SBERT_BACKEND != 'torch':
+    try:
+        sbert_model = load_requested_backend()
+    except Exception as e:
+        print(f"🚨 ERROR FATAL: No se pudo cargar el backend '{SBERT_BACKEND}' pedido en SBERT_BACKEND: {e}")
+        raise
+else:
+    try:
+        from sentence_transformers import SentenceTransformer
+        sbert_model = SentenceTransformer(MODEL_NAME, device=SBERT_DEVICE)
+        if SBERT_DEVICE == 'cuda':
+            sbert_model.half()
+        print(f"✅ Modelo S-BERT cargado en {SBERT_DEVICE}.")
+    except ImportError:
+        print("🚨 ERROR: No se encontró la librería 'sentence_transformers'. Usando modelo dummy.")
+        sbert_model = DummyModel()
+    except Exception as e:
+        print(f"⚠️ Advertencia: No se pudo cargar el modelo SBERT. Usando dummy: {e}")
+        sbert_model = DummyModel()
+
+EMBEDDING_DIM = sbert_model.get_sentence_embedding_dimension()
+
+# Identidad del codificador con el que se generan los vectores (se guarda junto al catálogo).
+# None con el modelo dummy: sus vectores nulos no deben reemplazar a los del catálogo
+DEFAULT_ENCODER_ID = f"torch:{MODEL_NAME}"
+if isinstance(sbert_model, DummyModel):
+    ENCODER_ID = None
+elif SBERT_BACKEND == 'model2vec':
+    ENCODER_ID = f"model2vec:{SBERT_M2V_MODEL}"
+elif SBERT_BACKEND == 'onnx':
+    ENCODER_ID = f"onnx:{MODEL_NAME}/{SBERT_ONNX_FILE}"
+else:
+    ENCODER_ID = DEFAULT_ENCODER_ID
+
+
+def encode_texts(texts, batch_size=32):
+    """Codifica una lista de textos con la configuración común: float32 y norma 1."""
+    # inference_mode desactiva por completo el seguimiento de autograd (más liviano que no_grad)
+    with (torch.inference_mode() if torch is not None else contextlib.nullcontext()):
+        embeddings = sbert_model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+    return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
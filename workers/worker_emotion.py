@@ -1,4 +1,4 @@
-import pika, json, os, time
+import pika, orjson, os, time
 from pysentimiento import create_analyzer
 from pika.exceptions import AMQPConnectionError
 
@@ -47,7 +47,7 @@ def callback(ch, method, properties, body):
         return
 
     try:
-        data = json.loads(body)
+        data = orjson.loads(body)
         texto = data.get("query", "") # Renombrado a 'query' por consistencia con app.py
         request_id = data.get("request_id") # OBTENER el ID DE SOLICITUD
         
@@ -68,17 +68,22 @@ def callback(ch, method, properties, body):
         ch.basic_publish(
             exchange='',
             routing_key=NEXT_QUEUE_NAME,
-            body=json.dumps({
+            body=orjson.dumps({
                 "emotion": emocion, 
                 "request_id": request_id,
                 "query": texto # <- CRUCIAL: Pasamos el texto/query original
             }), 
-            properties=pika.BasicProperties(delivery_mode=2)
+            # reply_to/correlation_id viajan hasta el recomendador, que responde directo a la WebApp
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                reply_to=properties.reply_to,
+                correlation_id=properties.correlation_id
+            )
         )
         print(f"[📤] Emoción y consulta enviada a '{NEXT_QUEUE_NAME}'")
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print("⚠️ Error de decodificación JSON. Descartando mensaje.")
         ch.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
@@ -1,23 +1,34 @@
 import pika
 import os
+import argparse
+import math
+import multiprocessing
 import time
 import requests
 import psycopg2
-import json
+import orjson
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from psycopg2 import sql
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
 from pika.exceptions import AMQPConnectionError
-# Importamos SentenceTransformer
-try:
-    from sentence_transformers import SentenceTransformer
-except ImportError:
-    print("🚨 ERROR: No se encontró la librería 'sentence_transformers'. Asegúrate de que esté en requirements.txt.")
-    class SentenceTransformer:
-        def __init__(self, *args, **kwargs):
-            pass 
-        def encode(self, *args, **kwargs):
-            return [0.0] * 384
-        def get_sentence_embedding_dimension(self):
-            return 384
+
+# Codificación de embeddings: tamaño de lote y procesos paralelos (1 = un solo proceso)
+ENCODE_BATCH_SIZE = int(os.getenv('ENCODE_BATCH_SIZE', 64))
+ENCODE_PROCESSES = int(os.getenv('ENCODE_PROCESSES', 1))
+if ENCODE_PROCESSES > 1:
+    # Repartir los núcleos entre procesos para no sobre-suscribir la CPU (debe fijarse antes de importar torch)
+    os.environ.setdefault('OMP_NUM_THREADS', str(max(1, (os.cpu_count() or 1) // ENCODE_PROCESSES)))
+
+# Modelo S-BERT compartido: se carga en el primer uso (load_sbert), no al importar este módulo.
+# Los procesos hijos de la codificación paralela re-ejecutan este módulo al arrancar (spawn)
+# y solo deben cargar el modelo, una vez, desde su inicializador.
+def load_sbert():
+    """Retorna el módulo modelo_sbert; el primer llamado del proceso carga el modelo."""
+    import modelo_sbert
+    return modelo_sbert
 
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 RABBITMQ_USER = os.getenv('RABBITMQ_DEFAULT_USER', 'guest') 
@@ -31,18 +42,10 @@ DB_PASS = os.getenv('DB_PASS', 'password')
 
 TMDB_API_KEY = os.getenv('TMDB_API_KEY')
 TMDB_URL = "https://api.themoviedb.org/3/movie/popular"
-
-MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-try:
-    model = SentenceTransformer(MODEL_NAME)
-    EMBEDDING_DIM = model.get_sentence_embedding_dimension()
-except Exception as e:
-    print(f"⚠️ Advertencia: No se pudo cargar el modelo SBERT. Usando dummy: {e}")
-    class DummyModel:
-        def encode(self, *args, **kwargs): return [0.0] * 384
-        def get_sentence_embedding_dimension(self): return 384
-    model = DummyModel()
-    EMBEDDING_DIM = model.get_sentence_embedding_dimension()
+MOVIE_LIMIT = 500
+TMDB_PAGE_SIZE = 20 # Resultados por página de /movie/popular
+TMDB_MAX_WORKERS = 4 # Peticiones concurrentes a TMDB
+INSERT_BATCH_SIZE = 500
 
 
 def get_db_connection():
@@ -62,11 +65,26 @@ def get_db_connection():
     raise Exception("❌ No se pudo conectar a la base de datos después de varios intentos.")
 
 
+def get_column_type(cursor, column, table='peliculas'):
+    """Tipo actual (con modificadores, p. ej. 'halfvec(384)') de una columna; None si no existe."""
+    cursor.execute("""
+        SELECT format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped;
+    """, (table, column))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
 def create_tables(conn):
     print("🛠️ Creando/Verificando tablas y extensión pgvector...")
+    modelo_sbert = load_sbert()
+    dim = modelo_sbert.EMBEDDING_DIM
     try:
         with conn.cursor() as cursor:
             cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+            # Volúmenes creados con una versión anterior: binary_quantize requiere pgvector >= 0.7
+            cursor.execute("ALTER EXTENSION vector UPDATE;")
             
             cursor.execute(sql.SQL("""
                 CREATE TABLE IF NOT EXISTS Peliculas (
@@ -74,71 +92,183 @@ def create_tables(conn):
                     tmdb_id INTEGER UNIQUE NOT NULL,
                     titulo VARCHAR(255) NOT NULL,
                     resumen TEXT, 
-                    rating_imdb NUMERIC(2, 1),
-                    embedding VECTOR(%(dim)s)
+                    rating_imdb NUMERIC(3, 1),
+                    embedding HALFVEC(%(dim)s)
+                );
+            """), {'dim': dim})
+            # Versión del catálogo (una sola fila): se incrementa con cada cambio de Peliculas y el
+            # recomendador la usa para invalidar su caché de recomendaciones
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS CatalogoVersion (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    version BIGINT NOT NULL DEFAULT 0,
+                    encoder TEXT
                 );
-            """), {'dim': EMBEDDING_DIM})
+            """)
+            # 'encoder' (codificador de los embeddings guardados) se agregó después de la tabla
+            if get_column_type(cursor, 'encoder', 'catalogoversion') is None:
+                cursor.execute("ALTER TABLE CatalogoVersion ADD COLUMN encoder TEXT;")
+            cursor.execute("INSERT INTO CatalogoVersion (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;")
+
+            # Embeddings en media precisión (halfvec, 2 bytes por dimensión): la mitad de bytes por fila
+            # que VECTOR. Solo se altera si hace falta: ALTER COLUMN TYPE bloquea la tabla y
+            # reconstruye el índice HNSW, y worker_inicial se ejecuta en cada reinicio
+            embedding_type = get_column_type(cursor, 'embedding')
+            if embedding_type != f"halfvec({dim})":
+                # Misma dimensión: se convierten los vectores. Otra dimensión (otro modelo): se vacían
+                # para que generate_embeddings los regenere, y el índice se recrea con la nueva dimensión
+                same_dim = embedding_type == f"vector({dim})"
+                print(f"🔄 Migrando columna embedding: {embedding_type} -> halfvec({dim})...")
+                if not same_dim:
+                    cursor.execute("DROP INDEX IF EXISTS peliculas_emb_hnsw;")
+                cursor.execute(sql.SQL("""
+                    ALTER TABLE Peliculas ALTER COLUMN embedding TYPE HALFVEC(%(dim)s)
+                    USING {using};
+                """).format(using=sql.SQL("embedding::halfvec(%(dim)s)" if same_dim else "NULL")), {'dim': dim})
+                bump_catalog_version(cursor)
+            # Catálogo codificado con otro modelo/backend (mismo número de dimensiones o no): sus vectores
+            # están en otro espacio que las consultas. Se vacían para que generate_embeddings los regenere.
+            # Un catálogo sin codificador registrado es anterior a este control: se generó con el modelo por defecto
+            if modelo_sbert.ENCODER_ID is not None:
+                cursor.execute("SELECT encoder FROM CatalogoVersion;")
+                stored_encoder = cursor.fetchone()[0] or modelo_sbert.DEFAULT_ENCODER_ID
+                if stored_encoder != modelo_sbert.ENCODER_ID:
+                    print(f"🔄 Cambio de codificador ({stored_encoder} -> {modelo_sbert.ENCODER_ID}). Se regenerarán los embeddings.")
+                    cursor.execute("UPDATE Peliculas SET embedding = NULL WHERE embedding IS NOT NULL;")
+                    bump_catalog_version(cursor)
+                cursor.execute(
+                    "UPDATE CatalogoVersion SET encoder = %s WHERE encoder IS DISTINCT FROM %s;",
+                    (modelo_sbert.ENCODER_ID, modelo_sbert.ENCODER_ID)
+                )
+
+            # El recomendador ordena por producto interno (<#>), que solo equivale al coseno con norma 1.
+            # Volúmenes anteriores guardaban embeddings sin normalizar: se normalizan una vez
+            # (las filas ya normalizadas y los vectores nulos no cumplen el filtro y no se tocan)
+            cursor.execute("""
+                UPDATE Peliculas SET embedding = l2_normalize(embedding)
+                WHERE embedding IS NOT NULL
+                  AND l2_norm(embedding) > 0
+                  AND abs(l2_norm(embedding) - 1) > 0.01;
+            """)
+            if cursor.rowcount > 0:
+                print(f"🔄 {cursor.rowcount} embeddings normalizados a norma 1.")
+                bump_catalog_version(cursor)
+
+            # Tablas creadas con NUMERIC(2, 1): un voto de 10.0 desbordaba y abortaba toda la carga
+            if get_column_type(cursor, 'rating_imdb') == "numeric(2,1)":
+                cursor.execute("ALTER TABLE Peliculas ALTER COLUMN rating_imdb TYPE NUMERIC(3, 1);")
+
+            # Índice HNSW sobre el embedding cuantizado a bits: es la etapa de candidatos
+            # del recomendador (ORDER BY ... <~> ... LIMIT), que deja de recorrer toda la tabla
+            cursor.execute(sql.SQL("""
+                CREATE INDEX IF NOT EXISTS peliculas_emb_hnsw ON Peliculas
+                USING hnsw ((binary_quantize(embedding)::bit(%(dim)s)) bit_hamming_ops)
+                WITH (m = 16, ef_construction = 64);
+            """), {'dim': dim})
             
             conn.commit()
-        print("✅ Tablas listas.")
+        print("✅ Tablas e índices listos.")
     except Exception as e:
         conn.rollback()
         print(f"❌ Error al crear tablas: {e}")
-        
-        
+
+
+def bump_catalog_version(cursor):
+    """Marca el catálogo como modificado (dentro de la transacción de quien llama)."""
+    cursor.execute("UPDATE CatalogoVersion SET version = version + 1;")
+
+
+def reset_tables(conn):
+    """Vacía el catálogo con TRUNCATE (conserva tablas e índices, a diferencia de DROP + CREATE)."""
+    print("🧹 Reiniciando catálogo de películas (TRUNCATE)...")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("TRUNCATE TABLE Peliculas RESTART IDENTITY;")
+            bump_catalog_version(cursor)
+        conn.commit()
+        print("✅ Catálogo vacío.")
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Error al reiniciar el catálogo: {e}")
+
+
+def count_movies(conn):
+    """Cantidad de películas ya cargadas en la DB."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM Peliculas;")
+        return cursor.fetchone()[0]
+
+
+def fetch_tmdb_page(session, url, api_key, page):
+    """Descarga una página de películas populares de TMDB."""
+    params = {"language": "es-ES", "page": page, "api_key": api_key}
+    response = session.get(url, params=params, timeout=10)
+    response.raise_for_status() # Esto lanzará el 401 si la clave sigue siendo inválida
+    return orjson.loads(response.content)
+
+
+def insert_movies(conn, movies):
+    """Inserta un lote de películas dentro de la transacción en curso (el COMMIT lo hace quien llama)."""
+    print(f"💾 Insertando {len(movies)} películas...")
+    with conn.cursor() as cursor:
+        insert_query = """
+            INSERT INTO Peliculas (tmdb_id, titulo, resumen, rating_imdb)
+            VALUES %s
+            ON CONFLICT (tmdb_id) DO NOTHING;
+        """
+        execute_values(cursor, insert_query, movies, page_size=INSERT_BATCH_SIZE)
+
+
 def fetch_and_store_movies(conn, url, api_key, limit=500):
+    """Descarga en paralelo las páginas necesarias de TMDB e inserta las películas por lotes."""
     print(f"📡 Cargando hasta {limit} películas populares de TMDB...")
-    headers = {} 
-    page = 1
+    pages = range(1, math.ceil(limit / TMDB_PAGE_SIZE) + 1)
     total_loaded = 0
+    batch = []
 
-    while total_loaded < limit:
-        params = {"language": "es-ES", "page": page, "api_key": api_key} 
-        
-        try:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status() # Esto lanzará el 401 si la clave sigue siendo inválida
-            data = response.json()
-            
-            movies_to_insert = []
-            for movie in data.get('results', []):
-                if total_loaded >= limit:
-                    break
-                    
-                movies_to_insert.append((
-                    movie.get('id'),
-                    movie.get('title'),
-                    movie.get('overview'), # overview de TMDB es el resumen/descripción
-                    movie.get('vote_average')
-                ))
-                total_loaded += 1
-                
-            if not data.get('results') or data.get('page') >= data.get('total_pages', 0):
-                break
-                
-            page += 1
-            
-            if movies_to_insert:
-                print(f"💾 Insertando {len(movies_to_insert)} películas...")
-                with conn.cursor() as cursor:
-                    insert_query = """
-                        INSERT INTO Peliculas (tmdb_id, titulo, resumen, rating_imdb)
-                        VALUES (%s, %s, %s, %s)
-                        ON CONFLICT (tmdb_id) DO NOTHING;
-                    """
-                    cursor.executemany(insert_query, movies_to_insert)
-                    conn.commit()
-            
-            if total_loaded >= limit:
-                break
-                
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Error al conectar con TMDB: {e}")
-            break
-        except Exception as e:
-            conn.rollback()
-            print(f"❌ Error al insertar datos en DB: {e}")
-            break
+    try:
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=TMDB_MAX_WORKERS) as executor:
+            futures = {executor.submit(fetch_tmdb_page, session, url, api_key, page): page for page in pages}
+
+            for future in as_completed(futures):
+                try:
+                    data = future.result()
+                except requests.exceptions.RequestException as e:
+                    print(f"❌ Error al conectar con TMDB (página {futures[future]}): {e}")
+                    continue
+                except orjson.JSONDecodeError as e:
+                    # Respuesta truncada o malformada: se omite la página, no toda la carga
+                    print(f"❌ Respuesta inválida de TMDB (página {futures[future]}): {e}")
+                    continue
+
+                for movie in data.get('results', []):
+                    if total_loaded >= limit:
+                        break
+                    batch.append((
+                        movie.get('id'),
+                        movie.get('title'),
+                        movie.get('overview'), # overview de TMDB es el resumen/descripción
+                        movie.get('vote_average')
+                    ))
+                    total_loaded += 1
+
+                # Insertar mientras siguen llegando las demás páginas
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    insert_movies(conn, batch)
+                    batch = []
+
+        if batch:
+            insert_movies(conn, batch)
+
+        with conn.cursor() as cursor:
+            bump_catalog_version(cursor)
+        # Un único COMMIT (un solo fsync del WAL) para toda la carga
+        conn.commit()
+    except Exception as e:
+        # Sin estado parcial: se descarta toda la carga
+        conn.rollback()
+        total_loaded = 0
+        print(f"❌ Error al insertar datos en DB: {e}")
 
     print(f"✅ Carga de películas finalizada. Total cargadas: {total_loaded}.")
 
@@ -153,6 +283,31 @@ def get_movie_ids_for_embedding(conn):
         print(f"❌ Error al obtener películas para embedding: {e}")
         return []
 
+def encode_chunk(texts):
+    """Codifica una parte de los textos dentro de un proceso hijo (el modelo ya está cargado)."""
+    return load_sbert().encode_texts(texts, batch_size=ENCODE_BATCH_SIZE)
+
+
+def encode_texts(texts):
+    """
+    Codifica los textos por lotes; con ENCODE_PROCESSES > 1 reparte los lotes entre varios procesos.
+    Los vectores salen normalizados (norma 1): la similitud coseno se reduce a un producto punto.
+    """
+    modelo_sbert = load_sbert()
+    use_pool = (
+        modelo_sbert.SBERT_DEVICE == 'cpu'
+        and ENCODE_PROCESSES > 1
+        and len(texts) >= ENCODE_BATCH_SIZE * ENCODE_PROCESSES
+    )
+    if use_pool:
+        print(f"⚙️ Codificando con {ENCODE_PROCESSES} procesos...")
+        chunks = [texts[i:i + ENCODE_BATCH_SIZE] for i in range(0, len(texts), ENCODE_BATCH_SIZE)]
+        # spawn: cada hijo carga solo el modelo en el inicializador (mismo SBERT_* heredado del entorno)
+        with multiprocessing.get_context('spawn').Pool(ENCODE_PROCESSES, initializer=load_sbert) as pool:
+            return np.concatenate(pool.map(encode_chunk, chunks))
+    return modelo_sbert.encode_texts(texts, batch_size=ENCODE_BATCH_SIZE)
+
+
 def generate_embeddings(conn):
     print("🧠 Generando embeddings para películas sin procesar...")
     movies_to_process = get_movie_ids_for_embedding(conn)
@@ -163,25 +318,36 @@ def generate_embeddings(conn):
 
     print(f"🎥 Se necesitan procesar {len(movies_to_process)} películas.")
     
-    texts = [resumen for _, resumen in movies_to_process if resumen]
-    tmdb_ids = [tmdb_id for tmdb_id, resumen in movies_to_process if resumen]
+    # Agrupar por texto: las sinopsis repetidas (sagas, cortos) se codifican una sola vez
+    text_to_ids = defaultdict(list)
+    for tmdb_id, resumen in movies_to_process:
+        if resumen and resumen.strip():
+            text_to_ids[resumen.strip()].append(tmdb_id)
+    texts = list(text_to_ids)
     
     if not texts:
         print("⚠️ No hay resúmenes válidos para generar embeddings.")
         return
 
     try:
-        embeddings = model.encode(texts, convert_to_tensor=False)
-        print(f"✅ Embeddings generados para {len(embeddings)} textos.")
+        embeddings = np.asarray(encode_texts(texts), dtype=np.float32)
+        print(f"✅ Embeddings generados para {len(embeddings)} textos únicos.")
 
-        updates = []
-        for tmdb_id, embedding in zip(tmdb_ids, embeddings):
-            embedding_str = '[' + ','.join(map(str, embedding)) + ']'
-            updates.append((embedding_str, tmdb_id))
+        # register_vector adapta los ndarray directamente al tipo vector de pgvector
+        updates = [
+            (embedding, tmdb_id)
+            for text, embedding in zip(texts, embeddings)
+            for tmdb_id in text_to_ids[text]
+        ]
 
         with conn.cursor() as cursor:
-            update_query = "UPDATE Peliculas SET embedding = %s WHERE tmdb_id = %s;"
-            cursor.executemany(update_query, updates)
+            update_query = """
+                UPDATE Peliculas SET embedding = v.embedding::halfvec
+                FROM (VALUES %s) AS v(embedding, tmdb_id)
+                WHERE Peliculas.tmdb_id = v.tmdb_id;
+            """
+            execute_values(cursor, update_query, updates, page_size=INSERT_BATCH_SIZE)
+            bump_catalog_version(cursor)
             conn.commit()
         print("✅ Base de datos actualizada con nuevos embeddings.")
 
@@ -198,22 +364,35 @@ def verify_population(conn):
         if results:
             print(f"🎥 Se encontraron {len(results)} películas de prueba:")
             for i, (titulo, resumen, rating, embedding) in enumerate(results):
-                embedding_status = "Sí" if embedding else "No"
+                embedding_status = "Sí" if embedding is not None else "No"
                 print(f"  {i+1}. {titulo} ({rating}/10) | Resumen: {resumen[:50]}... | Embedding: {embedding_status}")
         else:
             print("⚠️ No hay películas cargadas.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carga inicial del catálogo de películas.")
+    parser.add_argument("--reset", action="store_true", help="Vacía Peliculas (TRUNCATE) antes de cargar.")
+    args = parser.parse_args()
+
     print("\n--- Iniciando Worker Inicial de DB ---")
     db_conn = get_db_connection()
     try:
         create_tables(db_conn)
+        # La extensión vector ya existe: registrar el adaptador numpy <-> vector
+        register_vector(db_conn)
+
+        if args.reset:
+            reset_tables(db_conn)
 
         if not TMDB_API_KEY:
             print("🚨 ERROR: TMDB_API_KEY no configurada. No se cargarán películas.")
         else:
-            fetch_and_store_movies(db_conn, TMDB_URL, TMDB_API_KEY, limit=500) 
+            existing = count_movies(db_conn)
+            if existing >= MOVIE_LIMIT:
+                print(f"⏭️ Ya hay {existing} películas cargadas. Se omite la descarga de TMDB.")
+            else:
+                fetch_and_store_movies(db_conn, TMDB_URL, TMDB_API_KEY, limit=MOVIE_LIMIT)
             
             generate_embeddings(db_conn)
             
@@ -2,21 +2,19 @@ import pika
 import os
 import time
 import psycopg2
-import json
-import requests
-from psycopg2 import sql
-from pika.exceptions import AMQPConnectionError, ConnectionClosedByBroker
+import orjson
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from psycopg2.pool import SimpleConnectionPool, PoolError
+from pgvector.psycopg2 import register_vector
+from pika.exceptions import AMQPConnectionError, ConnectionClosedByBroker, UnroutableError
 
 # --- IMPORTACIONES DE IA ---
-# Importamos SentenceTransformer
-try:
-    from sentence_transformers import SentenceTransformer
-except ImportError:
-    print("🚨 ERROR: No se encontró la librería 'sentence_transformers'. Usando clase dummy.")
-    class SentenceTransformer:
-        def __init__(self, *args, **kwargs): pass 
-        def encode(self, *args, **kwargs): return [0.0] * 384
-        def get_sentence_embedding_dimension(self): return 384
+# Modelo S-BERT compartido con worker_inicial (misma configuración para consultas y catálogo)
+import modelo_sbert
+from modelo_sbert import MODEL_NAME, EMBEDDING_DIM
 
 # Importamos la librería de Gemini
 try:
@@ -34,16 +32,6 @@ except ImportError:
     class APIError(Exception): pass
 # -----------------------------
 
-MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-try:
-    sbert_model = SentenceTransformer(MODEL_NAME)
-    EMBEDDING_DIM = sbert_model.get_sentence_embedding_dimension()
-    print(f"✅ Modelo S-BERT cargado. Dimensión: {EMBEDDING_DIM}")
-except Exception as e:
-    print(f"⚠️ Advertencia: No se pudo cargar el modelo SBERT. Usando dummy: {e}")
-    sbert_model = SentenceTransformer()
-    EMBEDDING_DIM = sbert_model.get_sentence_embedding_dimension()
-
 
 # ---------------- CONFIGURACIONES GLOBALES ---------------- #
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
@@ -54,16 +42,60 @@ RABBITMQ_PASS = os.getenv('RABBITMQ_DEFAULT_PASS', 'guest')
 QUEUE_NAME_IN = 'cola_emocion_detectada' 
 QUEUE_NAME_OUT = 'cola_resultados_finales'
 
+# Mensajes de un lote personalizados en paralelo (las reescrituras con Gemini son I/O).
+# La DB y las cachés las usa solo el hilo consumidor, una vez por lote
+MAX_CONCURRENT_MESSAGES = int(os.getenv('RECOMMENDER_CONCURRENCY', 4))
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_MESSAGES)
+
+# Pool propio para las reescrituras con Gemini: EXECUTOR espera por ellas, compartirlo podría bloquearse
+GEMINI_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Lotes de consultas: una sola llamada a model.encode por lote
+BATCH_SIZE = int(os.getenv('RECOMMENDER_BATCH_SIZE', 8))
+BATCH_WINDOW = 0.02 # Segundos máximos de espera para completar un lote
+BATCH_POLL_INTERVAL = 0.01
+# Mensajes sin confirmar que RabbitMQ puede adelantar: mientras se procesa un lote,
+# el siguiente ya está en el buffer del cliente (nunca menos que un lote completo)
+PREFETCH_COUNT = max(BATCH_SIZE, int(os.getenv('RECOMMENDER_PREFETCH', 32)))
+
+# Películas recomendadas por mensaje
+RECOMMENDATIONS_PER_REQUEST = 5
+
+# Etiquetas de pysentimiento (task="emotion", lang="es") que emite worker_emotion;
+# se usan para calentar el modelo y las cachés antes de consumir
+WARMUP_EMOTIONS = ["joy", "sadness", "anger", "fear", "surprise", "disgust", "others"]
+
+# Candidatos que la etapa binaria (Hamming) pasa al reordenamiento en media precisión (halfvec)
+RERANK_CANDIDATES = 50
+# Amplitud de búsqueda del índice HNSW: debe ser >= RERANK_CANDIDATES o el índice devuelve menos filas
+HNSW_EF_SEARCH = 64
+
 # Configuración de la base de datos
 DB_HOST = os.getenv('DB_HOST', 'db')
 DB_NAME = os.getenv('DB_NAME', 'cinesense_ai_db')
 DB_USER = os.getenv('DB_USER', 'cinesense_user')
 DB_PASS = os.getenv('DB_PASS', 'password')
+DB_POOL = None
+DB_RETRY_DELAY = 2 # Segundos de espera antes de reencolar un lote por un error de conexión
+PREPARED_CONNECTIONS = set() # Conexiones del pool que ya tienen las sentencias preparadas
 
 # Configuración de Gemini
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GEMINI_MODEL = 'gemini-2.5-flash' # Modelo rápido para esta tarea
 GEMINI_CLIENT = None
+REWRITE_CACHE_SIZE = 4096 # Sinopsis reescritas en memoria por (sinopsis, emoción)
+
+# Caché LRU de embeddings de consulta {(modelo, texto): vector}; solo la usa el hilo consumidor
+QUERY_EMBEDDING_CACHE = OrderedDict()
+QUERY_EMBEDDING_CACHE_SIZE = 10_000
+
+# Caché de recomendaciones por emoción; se invalida cuando cambia la versión del catálogo
+# (tabla CatalogoVersion, que worker_inicial incrementa en cada carga, embedding o reinicio)
+RECOMMENDATIONS_CACHE = {}
+CATALOG_VERSION = None
+CATALOG_CHECKED_AT = 0.0
+CATALOG_CHECK_INTERVAL = 1.0 # Segundos entre lecturas de la versión (no una por lote)
+# Sin lock: estas cachés, PREPARED_CONNECTIONS y el pool solo los usa el hilo consumidor
 # --------------------------------------------------------- #
 
 
@@ -91,11 +123,29 @@ def init_gemini_client():
 def rewrite_synopsis_with_gemini(synopsis: str, emotion: str) -> str:
     """
     Usa la API de Gemini para reescribir la sinopsis, ajustando el tono a la emoción.
-    La lógica se amplía para manejar más estados de ánimo con instrucciones específicas.
+    Si Gemini no está disponible o falla, retorna la sinopsis original.
     """
     if not GEMINI_CLIENT:
         return synopsis # Retorna el original si el cliente no está disponible
-    
+
+    try:
+        return rewrite_synopsis_cached(synopsis, emotion)
+    except APIError as e:
+        print(f"⚠️ Error en la llamada a la API de Gemini. Fallback a sinopsis original: {e}")
+        return synopsis
+    except Exception as e:
+        print(f"⚠️ Error inesperado al usar Gemini. Fallback: {e}")
+        return synopsis
+
+
+@functools.lru_cache(maxsize=REWRITE_CACHE_SIZE)
+def rewrite_synopsis_cached(synopsis: str, emotion: str) -> str:
+    """
+    Llamada a Gemini memoizada por (sinopsis, emoción): el catálogo y las emociones son acotados,
+    así que las mismas combinaciones se repiten entre usuarios. Los errores se propagan para que
+    el fallback nunca quede guardado en la caché.
+    La lógica se amplía para manejar más estados de ánimo con instrucciones específicas.
+    """
     # 1. Lógica de mapeo de emoción a instrucción específica
     emotion_lower = emotion.lower()
     tone_instruction = ""
@@ -131,19 +181,11 @@ def rewrite_synopsis_with_gemini(synopsis: str, emotion: str) -> str:
     Emoción del Usuario: "{emotion}"
     """
 
-    try:
-        response = GEMINI_CLIENT.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=prompt
-        )
-        new_synopsis = response.text.strip().replace('"', '')
-        return new_synopsis
-    except APIError as e:
-        print(f"⚠️ Error en la llamada a la API de Gemini. Fallback a sinopsis original: {e}")
-        return synopsis
-    except Exception as e:
-        print(f"⚠️ Error inesperado al usar Gemini. Fallback: {e}")
-        return synopsis
+    response = GEMINI_CLIENT.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=prompt
+    )
+    return response.text.strip().replace('"', '')
 
 # ---------------- CONEXIÓN DB ---------------- #
 def get_db_connection():
@@ -163,6 +205,100 @@ def get_db_connection():
             time.sleep(5)
     raise Exception("🚨 No se pudo conectar a la base de datos después de múltiples intentos.")
 
+def init_db_pool():
+    """
+    Crea el pool de conexiones del recomendador. Solo el hilo consumidor consulta la DB
+    (una sentencia por lote), así que basta una conexión; el pool la reabre si se rompe.
+    """
+    global DB_POOL
+    DB_POOL = SimpleConnectionPool(
+        1,
+        1,
+        host=DB_HOST,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASS,
+        options=f"-c hnsw.ef_search={HNSW_EF_SEARCH}"
+    )
+    # Adaptador numpy <-> vector de pgvector para todas las conexiones del pool
+    conn = DB_POOL.getconn()
+    try:
+        register_vector(conn, globally=True)
+    finally:
+        DB_POOL.putconn(conn)
+
+
+# Búsqueda en dos etapas para todas las consultas de un lote en una sola sentencia,
+# compuesta una sola vez al importar el módulo. Por cada embedding de $1 (LATERAL):
+# 1) candidatos por distancia de Hamming sobre el embedding cuantizado a bits
+#    (384 bits = 48 bytes por fila en lugar de 768 bytes de halfvec)
+# 2) reordenamiento en media precisión solo sobre esos candidatos, por producto interno negativo (<#>):
+#    los embeddings se guardan y consultan con norma 1, así que equivale al coseno sin normalizar
+#    El catálogo se guarda como halfvec: la consulta se convierte a halfvec para compararla
+# $1 = embeddings de las consultas, $2 = candidatos de la etapa binaria, $3 = resultados por consulta.
+PREPARE_RECOMMENDATION_SQL = f"""
+        PREPARE recomendar_peliculas(vector[], int, int) AS
+            SELECT
+                q.ord,
+                p.titulo,
+                p.resumen,
+                p.rating_imdb::float8,
+                -t.distance AS score -- <#> es el producto interno negado: score = similitud coseno
+            FROM
+                UNNEST($1) WITH ORDINALITY AS q(embedding, ord)
+                CROSS JOIN LATERAL (
+                    SELECT
+                        c.id,
+                        c.embedding <#> q.embedding::halfvec AS distance
+                    FROM (
+                        SELECT
+                            id,
+                            embedding
+                        FROM
+                            Peliculas
+                        WHERE 
+                            embedding IS NOT NULL
+                        ORDER BY
+                            binary_quantize(embedding)::bit({int(EMBEDDING_DIM)}) <~> binary_quantize(q.embedding)
+                        LIMIT $2
+                    ) c
+                    ORDER BY
+                        distance
+                    LIMIT $3
+                ) t
+                -- Título, sinopsis y rating solo para las filas finales, no para los candidatos
+                JOIN Peliculas p ON p.id = t.id
+            ORDER BY
+                q.ord,
+                t.distance
+"""
+EXECUTE_RECOMMENDATION_SQL = "EXECUTE recomendar_peliculas(%s::vector[], %s, %s);"
+
+
+def prepare_statements(conn):
+    """
+    Prepara la búsqueda de recomendaciones una vez por conexión del pool: Postgres la analiza
+    y planifica una sola vez y cada mensaje solo ejecuta EXECUTE con los parámetros.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(PREPARE_RECOMMENDATION_SQL)
+
+
+@contextmanager
+def pooled_db_connection():
+    """Presta una conexión del pool y la devuelve al terminar (descartándola si quedó rota)."""
+    conn = DB_POOL.getconn()
+    try:
+        conn.autocommit = True # El recomendador solo lee
+        if conn not in PREPARED_CONNECTIONS:
+            prepare_statements(conn)
+            PREPARED_CONNECTIONS.add(conn)
+        yield conn
+    finally:
+        if conn.closed:
+            PREPARED_CONNECTIONS.discard(conn)
+        DB_POOL.putconn(conn, close=bool(conn.closed))
+
 # ---------------- CONEXIÓN RABBITMQ ---------------- #
 def get_rabbitmq_connection():
     """Intenta conectarse a RabbitMQ con reintentos."""
@@ -177,73 +313,189 @@ def get_rabbitmq_connection():
 
 # ---------------- LÓGICA DE RECOMENDACIÓN ---------------- #
 
-def get_recommendations_from_db(conn, emotion, limit=3):
+def build_query_text(emotion):
     """
-    Busca las 'limit' películas más cercanas a la emoción/sentimiento dado.
-    (Tu lógica de S-BERT y pgvector)
+    Texto de búsqueda semántica para una emoción. Se normaliza (espacios y mayúsculas)
+    porque también es la clave de QUERY_EMBEDDING_CACHE: 'Alegría ' y 'alegría' comparten entrada.
     """
-    global sbert_model, EMBEDDING_DIM
-    
-    query_text = f"Una película que me haga sentir {emotion.lower()}"
-    
-    if sbert_model:
-        emotion_embedding = sbert_model.encode(query_text).tolist()
-    else:
-        emotion_embedding = [0.0] * EMBEDDING_DIM
+    return f"Una película que me haga sentir {' '.join(emotion.split()).lower()}"
+
+
+def encode_emotion_queries(emotions):
+    """
+    Codifica en una sola llamada al modelo las consultas de varias emociones (sin repetir).
+    Las consultas ya vistas salen de QUERY_EMBEDDING_CACHE sin pasar por el transformer.
+    Retorna {emocion: embedding float32 de norma 1}.
+    """
+    embeddings = {}
+    missing = []
+    for emotion in dict.fromkeys(emotions):
+        key = (MODEL_NAME, build_query_text(emotion))
+        cached = QUERY_EMBEDDING_CACHE.get(key)
+        if cached is not None:
+            QUERY_EMBEDDING_CACHE.move_to_end(key)
+            embeddings[emotion] = cached
+        else:
+            missing.append(emotion)
+
+    if missing:
+        texts = [build_query_text(emotion) for emotion in missing]
+        # Mismo espacio que el catálogo: vectores de norma 1
+        encoded = modelo_sbert.encode_texts(texts, batch_size=len(texts))
+        for emotion, text, embedding in zip(missing, texts, encoded):
+            QUERY_EMBEDDING_CACHE[(MODEL_NAME, text)] = embedding
+            embeddings[emotion] = embedding
+        while len(QUERY_EMBEDDING_CACHE) > QUERY_EMBEDDING_CACHE_SIZE:
+            QUERY_EMBEDDING_CACHE.popitem(last=False)
+
+    return embeddings
+
+
+def get_recommendations_from_db(conn, emotion_embeddings, limit=3):
+    """
+    Busca las 'limit' películas más cercanas a cada emoción/sentimiento dado.
+    Recibe {emocion: embedding} y resuelve todas las emociones con una sola sentencia.
+    Retorna {emocion: [recomendaciones]}.
+    """
+    emotions = list(emotion_embeddings)
+    recommendations = {emotion: [] for emotion in emotions}
+    if not emotions:
+        return recommendations
 
-    embedding_str = '[' + ','.join(map(str, emotion_embedding)) + ']'
-    
-    # print(f"[🔍] Buscando películas similares a: '{query_text}' (vector dim: {EMBEDDING_DIM})")
-    
     try:
         with conn.cursor() as cursor:
-            # Consulta de similitud vectorial (coseno)
-            query = sql.SQL("""
-                SELECT
-                    titulo,
-                    resumen,
-                    rating_imdb,
-                    1 - (embedding <=> %s) AS score
-                FROM
-                    Peliculas
-                WHERE 
-                    embedding IS NOT NULL
-                ORDER BY
-                    embedding <=> %s
-                LIMIT %s;
-            """)
-            
-            cursor.execute(query, [embedding_str, embedding_str, limit])
-            
-            results = cursor.fetchall()
-            recommendations = []
-            
-            if not results:
-                 return [] 
+            # Búsqueda en dos etapas (binaria + reordenamiento por producto interno), preparada en la
+            # conexión (ver prepare_statements): solo viajan los parámetros.
+            # register_vector adapta cada ndarray directamente (sin construir el literal a mano)
+            cursor.execute(
+                EXECUTE_RECOMMENDATION_SQL,
+                [[emotion_embeddings[emotion] for emotion in emotions], max(RERANK_CANDIDATES, limit), limit]
+            )
 
-            for titulo, resumen, rating, score in results:
-                recommendations.append({
+            # ord es 1-based y sigue el orden de 'emotions'
+            # Rating y score ya llegan como float desde SQL (sin Decimal que convertir)
+            for ord_, titulo, resumen, rating, score in cursor.fetchall():
+                emotion = emotions[ord_ - 1]
+                recommendations[emotion].append({
                     "titulo": titulo,
                     "resumen": resumen,
-                    "rating_imdb": float(rating),
-                    "score": float(score),
+                    "rating_imdb": rating,
+                    "score": score,
                     "emocion_buscada": emotion
                 })
             return recommendations
 
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # Conexión caída (p. ej. la DB se reinició): quien llama reencola el lote
+        raise
     except psycopg2.Error as e:
         print(f"🚨 ERROR de DB al obtener recomendaciones: {e}")
-        return []
+        return {emotion: [] for emotion in emotions}
     except Exception as e:
         print(f"🚨 Error inesperado en la lógica de recomendación: {e}")
-        return []
+        return {emotion: [] for emotion in emotions}
+
+
+def get_catalog_version(conn):
+    """Versión actual del catálogo: una fila de CatalogoVersion, leída por clave primaria."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT version FROM CatalogoVersion;")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+
+def get_cached_recommendations(conn, emotion_embeddings, limit=3):
+    """
+    Igual que get_recommendations_from_db, pero reutiliza el resultado de cada emoción
+    mientras el catálogo no cambie; solo las emociones sin caché van a la DB (en una sola sentencia).
+    La versión se consulta como máximo cada CATALOG_CHECK_INTERVAL segundos.
+    Las listas retornadas son compartidas: quien las modifique debe copiarlas antes.
+    """
+    global CATALOG_VERSION, CATALOG_CHECKED_AT
+    now = time.monotonic()
+    if CATALOG_VERSION is None or now - CATALOG_CHECKED_AT >= CATALOG_CHECK_INTERVAL:
+        version = get_catalog_version(conn)
+        CATALOG_CHECKED_AT = now
+    else:
+        version = CATALOG_VERSION
+
+    if version != CATALOG_VERSION:
+        RECOMMENDATIONS_CACHE.clear()
+        CATALOG_VERSION = version
+
+    recommendations = {}
+    for emotion in emotion_embeddings:
+        cached = RECOMMENDATIONS_CACHE.get((emotion, limit))
+        if cached is not None:
+            recommendations[emotion] = cached
+
+    missing = {emotion: embedding for emotion, embedding in emotion_embeddings.items() if emotion not in recommendations}
+    if missing:
+        fetched = get_recommendations_from_db(conn, missing, limit)
+        for emotion, movies in fetched.items():
+            if movies:
+                RECOMMENDATIONS_CACHE[(emotion, limit)] = movies
+        recommendations.update(fetched)
+
+    return recommendations
 
 
 # ---------------- CONSUMIDOR DE RABBITMQ ---------------- #
-def callback(ch, method, properties, body):
-    conn = None
-    try:
-        data = json.loads(body)
+def build_recommendation_payload(request_id, emotion, recommendations):
+    """
+    Personaliza las recomendaciones (ya obtenidas de la DB) para un mensaje decodificado.
+    Retorna el payload final (bytes). Se ejecuta en un hilo del pool: no debe tocar el canal de RabbitMQ.
+    'recommendations' debe ser una copia propia: se modifica en el lugar.
+    """
+    # 1. PERSONALIZACIÓN DE LA SINOPSIS CON GEMINI (Paso Clave)
+    # Las llamadas a Gemini son I/O: se lanzan en paralelo (tiempo total ≈ la más lenta)
+    rewrites = {}
+    for index, movie in enumerate(recommendations):
+        original_synopsis = movie.pop('resumen', None)
+        if original_synopsis:
+            rewrites[index] = GEMINI_EXECUTOR.submit(rewrite_synopsis_with_gemini, original_synopsis, emotion)
+
+    for index, movie in enumerate(recommendations):
+        if index in rewrites:
+            # ✅ CORRECCIÓN 1: Usar 'sinopsis' (esperado por el frontend)
+            movie['sinopsis'] = rewrites[index].result()
+        else:
+            # Asegurarse de que al menos la clave exista si no hubo sinopsis original
+            movie['sinopsis'] = "Sin sinopsis original disponible para personalizar."
+        # ✅ CORRECCIÓN 2: Usar 'emocion_usada' (esperado por el frontend)
+        movie['emocion_usada'] = emotion
+    
+    # 2. Resultado final
+    # orjson devuelve bytes, listos para basic_publish
+    return orjson.dumps({
+        "request_id": request_id,
+        "recommendations": recommendations
+    })
+
+
+def process_batch(ch, deliveries):
+    """
+    Procesa un lote de mensajes: una sola llamada al modelo y una sola consulta a la DB para todas
+    las emociones, Gemini en paralelo en el pool, y publish/ack en el hilo de la conexión.
+    Los mensajes completados se confirman con un único basic_ack(multiple=True) al final del lote.
+    """
+    pending = []
+    acked_tags = []
+    for method, properties, body in deliveries:
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            print(f"⚠️ Error de JSON Decode. Cuerpo del mensaje: {body}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            continue
+
+        # Un JSON válido que no es un objeto ([], 1, "x") no tiene .get: se descarta aquí,
+        # sin afectar al resto del lote ni al bucle del consumidor
+        if not isinstance(data, dict):
+            print(f"⚠️ Mensaje inválido (no es un objeto JSON). Descartando: {body}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            continue
+
         # CORRECCIÓN: El worker_emotion.py envía 'emotion'
         emotion = data.get("emotion") 
         request_id = data.get("request_id")
@@ -252,61 +504,146 @@ def callback(ch, method, properties, body):
 
         if not emotion or not request_id:
             print(f"⚠️ Mensaje inválido. Faltan datos. Body: {data}")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            return
+            acked_tags.append(method.delivery_tag)
+            continue
 
-        # 1. Lógica de Recomendación (DB)
-        conn = get_db_connection()
-        recommendations = get_recommendations_from_db(conn, emotion, limit=5)
-        
-        # 2. PERSONALIZACIÓN DE LA SINOPSIS CON GEMINI (Paso Clave)
-        if recommendations:
-            for movie in recommendations:
-                original_synopsis = movie.get('resumen')
-                
-                # Eliminamos la clave 'resumen' original de la DB (ya no es necesaria)
-                if 'resumen' in movie:
-                    del movie['resumen']
-                    
-                if original_synopsis:
-                    # ✅ CORRECCIÓN 1: Usar 'sinopsis' (esperado por el frontend)
-                    movie['sinopsis'] = rewrite_synopsis_with_gemini(original_synopsis, emotion)
-                    
-                    # ✅ CORRECCIÓN 2: Usar 'emocion_usada' (esperado por el frontend)
-                    movie['emocion_usada'] = emotion
-                else:
-                    # Asegurarse de que al menos la clave exista si no hubo sinopsis original
-                    movie['sinopsis'] = "Sin sinopsis original disponible para personalizar."
-                    movie['emocion_usada'] = emotion
-        
-        # 3. Envío del resultado final
-        final_payload = json.dumps({
-            "request_id": request_id,
-            "recommendations": recommendations
-        })
-        
-        ch.basic_publish(
-            exchange='',
-            routing_key=QUEUE_NAME_OUT,
-            body=final_payload,
-            properties=pika.BasicProperties(
-                delivery_mode=2,
-            )
-        )
-        
-        print(f"[📤] Recomendaciones (personalizadas) enviadas a '{QUEUE_NAME_OUT}' para ID: {request_id}")
-        
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        
-    except json.JSONDecodeError:
-        print(f"⚠️ Error de JSON Decode. Cuerpo del mensaje: {body}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        # Tipos incorrectos harían fallar la codificación (o el publish) de todo el lote
+        if not isinstance(emotion, str) or not isinstance(request_id, str):
+            print(f"⚠️ Mensaje inválido. 'emotion' y 'request_id' deben ser texto. Descartando: {data}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            continue
+
+        pending.append((method.delivery_tag, request_id, emotion, properties))
+
+    if pending:
+        acked_tags.extend(publish_recommendations(ch, pending))
+
+    # Los fallos ya se rechazaron con nack, y los mensajes prefetch del próximo lote tienen tags
+    # mayores: confirmar hasta el tag más alto cubre exactamente los mensajes completados
+    if acked_tags:
+        ch.basic_ack(delivery_tag=max(acked_tags), multiple=True)
+
+
+def publish_recommendations(ch, pending):
+    """
+    Calcula y publica las recomendaciones de los mensajes válidos del lote.
+    Rechaza (nack) los que fallan y retorna los delivery tags de los publicados.
+    """
+    try:
+        embeddings = encode_emotion_queries([emotion for _, _, emotion, _ in pending])
     except Exception as e:
-        print(f"🚨 ERROR CRÍTICO en callback del Recomendador: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True) 
-    finally:
-        if conn:
-            conn.close()
+        print(f"🚨 ERROR CRÍTICO al codificar el lote en el Recomendador: {e}")
+        for delivery_tag, _, _, _ in pending:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        return []
+
+    # Lógica de Recomendación (DB): una sola sentencia para todas las emociones del lote
+    try:
+        with pooled_db_connection() as conn:
+            recommendations = get_cached_recommendations(conn, embeddings, limit=RECOMMENDATIONS_PER_REQUEST)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError) as e:
+        # Error de conexión (transitorio): reencolar tras una pausa, sin bucle de reentregas inmediatas
+        print(f"🚨 DB no disponible para el lote en el Recomendador. Reencolando en {DB_RETRY_DELAY}s: {e}")
+        time.sleep(DB_RETRY_DELAY)
+        for delivery_tag, _, _, _ in pending:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        return []
+    except Exception as e:
+        # Esquema aún no creado, pgvector sin actualizar, etc.: reintentar no lo arregla.
+        # Igual que la lógica original, se responde sin recomendaciones
+        print(f"🚨 ERROR de DB al obtener recomendaciones para el lote: {e}")
+        recommendations = {emotion: [] for emotion in embeddings}
+
+    futures = [
+        (delivery_tag, request_id, properties, EXECUTOR.submit(
+            build_recommendation_payload,
+            request_id,
+            emotion,
+            [dict(movie) for movie in recommendations[emotion]]
+        ))
+        for delivery_tag, request_id, emotion, properties in pending
+    ]
+
+    published = []
+    for delivery_tag, request_id, properties, future in futures:
+        try:
+            final_payload = future.result()
+        except Exception as e:
+            print(f"🚨 ERROR CRÍTICO en callback del Recomendador: {e}")
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            continue
+
+        reply_queue = publish_result(ch, properties, request_id, final_payload)
+        print(f"[📤] Recomendaciones (personalizadas) enviadas a '{reply_queue}' para ID: {request_id}")
+        published.append(delivery_tag)
+
+    return published
+
+
+def publish_result(ch, properties, request_id, body):
+    """
+    Publica el resultado en la cola de respuesta de la WebApp que hizo la consulta (RPC).
+    Esa cola es exclusiva y desaparece si la WebApp se reinicia: con mandatory=True (y
+    confirmaciones en el canal) el broker la devuelve y el resultado va a la cola durable
+    compartida, donde lo recoge la WebApp reiniciada. Retorna la cola usada.
+    """
+    result_properties = pika.BasicProperties(
+        delivery_mode=2,
+        correlation_id=properties.correlation_id or request_id
+    )
+    if properties.reply_to:
+        try:
+            ch.basic_publish(
+                exchange='',
+                routing_key=properties.reply_to,
+                body=body,
+                properties=result_properties,
+                mandatory=True
+            )
+            return properties.reply_to
+        except UnroutableError:
+            print(f"⚠️ La cola de respuesta '{properties.reply_to}' ya no existe. Usando '{QUEUE_NAME_OUT}'.")
+
+    ch.basic_publish(
+        exchange='',
+        routing_key=QUEUE_NAME_OUT,
+        body=body,
+        properties=result_properties
+    )
+    return QUEUE_NAME_OUT
+
+
+def warm_up():
+    """
+    Ejecuta el camino completo una vez antes de consumir: la primera llamada al modelo
+    (inicialización de kernels e hilos) y la primera sentencia preparada no recaen en un mensaje real.
+    Deja además en caché los embeddings y recomendaciones de las emociones conocidas.
+    """
+    start = time.monotonic()
+    modelo_sbert.encode_texts(["calentamiento"], batch_size=1) # Lote de 1
+    embeddings = encode_emotion_queries(WARMUP_EMOTIONS) # Lote de varias
+    with pooled_db_connection() as conn:
+        get_cached_recommendations(conn, embeddings, limit=RECOMMENDATIONS_PER_REQUEST)
+    print(f"🔥 Modelo y DB precalentados en {time.monotonic() - start:.2f}s.")
+
+
+def consume_in_batches(ch):
+    """
+    Lee mensajes de QUEUE_NAME_IN y los agrupa hasta BATCH_SIZE mensajes o BATCH_WINDOW segundos
+    desde el primero del lote, lo que ocurra antes.
+    """
+    batch = []
+    deadline = None
+    for method, properties, body in ch.consume(QUEUE_NAME_IN, auto_ack=False, inactivity_timeout=BATCH_POLL_INTERVAL):
+        if method is not None:
+            batch.append((method, properties, body))
+            if deadline is None:
+                deadline = time.monotonic() + BATCH_WINDOW
+
+        if batch and (len(batch) >= BATCH_SIZE or time.monotonic() >= deadline):
+            process_batch(ch, batch)
+            batch = []
+            deadline = None
             
 # ---------------- MAIN ---------------- #
 if __name__ == "__main__":
@@ -319,11 +656,18 @@ if __name__ == "__main__":
     try:
         conn = get_db_connection()
         conn.close()
-        print("✅ Conexión inicial a DB exitosa.")
+        init_db_pool()
+        print("✅ Conexión inicial a DB exitosa. Pool de conexiones listo.")
     except Exception as e:
         print(f"🚨 ERROR FATAL: La DB no está disponible al iniciar. {e}")
         exit(1)
 
+    # El calentamiento es opcional: si falla (p. ej. catálogo aún no creado), se consume igual
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"⚠️ Advertencia: No se pudo precalentar el recomendador: {e}")
+
     # 3. Conectar a RabbitMQ e iniciar consumidor
     max_retries = 10
     attempt = 0
@@ -335,10 +679,12 @@ if __name__ == "__main__":
             channel.queue_declare(queue=QUEUE_NAME_IN, durable=True)
             channel.queue_declare(queue=QUEUE_NAME_OUT, durable=True)
 
-            channel.basic_qos(prefetch_count=1) 
-            channel.basic_consume(queue=QUEUE_NAME_IN, on_message_callback=callback, auto_ack=False) 
+            # RabbitMQ adelanta varios lotes sin esperar confirmaciones
+            channel.basic_qos(prefetch_count=PREFETCH_COUNT)
+            # Confirmaciones del broker: necesarias para detectar respuestas no enrutables (mandatory)
+            channel.confirm_delivery()
             print(f'✅ Worker Recomendador listo. Esperando mensajes en la cola: {QUEUE_NAME_IN}.')
-            channel.start_consuming()
+            consume_in_batches(channel)
 
         except (AMQPConnectionError, ConnectionClosedByBroker) as e:
             print(f"❌ Conexión RabbitMQ fallida. Reiniciando conexión en 5 segundos... ({e})")